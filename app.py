@@ -5,6 +5,11 @@ import os
 import json
 from datetime import datetime
 import tempfile
+import threading
+from prefetch import Prefetcher, PRIORITY_SINGLE, PRIORITY_BACKGROUND
+from download_store import DownloadStore, extension_for_content_type
+from resolver_pool import ResolverPool
+from negative_cache import NegativeCache, PERMANENT, TRANSIENT, classify_failure
 
 app = Flask(__name__)
 
@@ -17,6 +22,25 @@ logging.basicConfig(
 # Cache de URLs
 CACHE_FILE = 'url_cache.json'
 PROCESSING_CACHE_FILE = 'processing_cache.json'
+DOWNLOAD_DIR = 'downloads'
+
+# Chaves recusadas pelo resolvedor (não são consultadas de novo até expirar)
+negative_cache = NegativeCache()
+
+# Pool de instâncias do resolvedor (RESOLVER_URLS ou API_HOST/API_PORT)
+resolver_pool = ResolverPool.from_env()
+
+# Prefetch em segundo plano (por padrão, um worker por vaga dos resolvedores;
+# mais workers que RESOLVER_SLOTS x instâncias ficariam parados)
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', resolver_pool.max_capacity()))
+PREFETCH_DOWNLOAD_XML = os.environ.get('PREFETCH_DOWNLOAD_XML', '0') == '1'
+PREFETCH_TOKEN = os.environ.get('CAPTCHA_TOKEN')
+
+# Downloads particionados por CNPJ/AAMM com manifesto
+download_store = DownloadStore(DOWNLOAD_DIR)
+
+# Protege o ciclo carregar/alterar/salvar do cache entre threads
+cache_lock = threading.Lock()
 
 def load_cache():
     """Carrega o cache de URLs do arquivo."""
@@ -31,16 +55,20 @@ def load_cache():
 def save_cache(cache_data):
     """Salva o cache de URLs no arquivo."""
     try:
-        with open(CACHE_FILE, 'w') as f:
+        # Grava em arquivo temporário e substitui, evitando leituras de JSON incompleto
+        tmp_file = f"{CACHE_FILE}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'w') as f:
             json.dump(cache_data, f, indent=4)
+        os.replace(tmp_file, CACHE_FILE)
     except Exception as e:
         logging.error(f"Erro ao salvar cache: {str(e)}")
 
 def clear_cache():
     """Limpa o cache de URLs."""
     try:
-        if os.path.exists(CACHE_FILE):
-            os.remove(CACHE_FILE)
+        with cache_lock:
+            if os.path.exists(CACHE_FILE):
+                os.remove(CACHE_FILE)
         return True
     except Exception as e:
         logging.error(f"Erro ao limpar cache: {str(e)}")
@@ -72,8 +100,16 @@ def read_nfe_keys(filename: str):
     except FileNotFoundError:
         return []
 
-def get_nfe_url(key: str, captcha_token=None):
-    """Obtém a URL de download da NFE e dados detalhados."""
+def is_valid_nfe_key(key: str) -> bool:
+    """Verifica se a chave NFe tem 44 dígitos numéricos."""
+    return key.isdigit() and len(key) == 44
+
+def get_nfe_url(key: str, captcha_token=None, interactive=False):
+    """Obtém a URL de download da NFE e dados detalhados.
+
+    Falhas transitórias em cache só bloqueiam o prefetch; chamadas interativas
+    (que podem trazer outro token 2captcha) consultam o resolvedor de novo.
+    """
     try:
         # Verifica primeiro no cache
         cache = load_cache()
@@ -86,6 +122,16 @@ def get_nfe_url(key: str, captcha_token=None):
                 'from_cache': True
             }
 
+        # Chave recusada recentemente pelo resolvedor: não gasta captcha de novo
+        failure = negative_cache.get(key)
+        if failure and (failure['kind'] == PERMANENT or not interactive):
+            return {
+                'success': False,
+                'message': failure['message'],
+                'failure_kind': failure['kind'],
+                'negative_cache': True
+            }
+
         # Verifica se o token 2captcha foi fornecido
         if not captcha_token:
             logging.warning(f"Token 2captcha não fornecido para a chave {key}")
@@ -94,25 +140,29 @@ def get_nfe_url(key: str, captcha_token=None):
                 'message': 'Token 2captcha não fornecido'
             }
 
-        # Se não estiver no cache, faz a requisição
-        url = "http://localhost:3002/api/nfe/interceptar-url"
+        # Se não estiver no cache, faz a requisição a uma instância do resolvedor
         payload = {
             "chave": key,
             "token2captcha": captcha_token
         }
         
         logging.info(f"Fazendo requisição para a chave {key} com token 2captcha")
-        response = requests.post(url, json=payload)
+        response = resolver_pool.request('POST', '/api/nfe/interceptar-url', json=payload)
         data = response.json()
         
         if data.get('success'):
-            # Salva no cache
-            cache[key] = {
-                'url': data['url'],
-                'dados': data.get('dadosNFe', None),
-                'timestamp': datetime.now().isoformat()
-            }
-            save_cache(cache)
+            # Salva no cache (recarrega para não perder entradas gravadas por outras threads).
+            # Chaves removidas durante a consulta não voltam para o cache.
+            with cache_lock:
+                if not prefetcher.is_cancelled(key):
+                    cache = load_cache()
+                    cache[key] = {
+                        'url': data['url'],
+                        'dados': data.get('dadosNFe', None),
+                        'timestamp': datetime.now().isoformat()
+                    }
+                    save_cache(cache)
+                    negative_cache.remove(key)
             
             return {
                 'success': True,
@@ -121,9 +171,18 @@ def get_nfe_url(key: str, captcha_token=None):
                 'message': 'URL obtida com sucesso',
                 'from_cache': False
             }
+
+        # Registra a recusa no cache negativo
+        message = data.get('message', 'Erro ao obter URL')
+        kind = classify_failure(message)
+        with cache_lock:
+            if not prefetcher.is_cancelled(key):
+                negative_cache.add(key, message, kind)
+        logging.info(f"Chave {key} recusada pelo resolvedor ({kind}): {message}")
         return {
             'success': False,
-            'message': data.get('message', 'Erro ao obter URL')
+            'message': message,
+            'failure_kind': kind
         }
     except Exception as e:
         return {
@@ -131,6 +190,64 @@ def get_nfe_url(key: str, captcha_token=None):
             'message': f'Erro ao processar requisição: {str(e)}'
         }
 
+def get_local_xml_path(key: str):
+    """Retorna o caminho do XML já baixado para a chave, se existir."""
+    filepath = download_store.get_path(key)
+    if filepath and filepath.endswith('.xml'):
+        return filepath
+    return None
+
+def download_xml_to_disk(key: str, url: str):
+    """Baixa o XML da NFE para o diretório de downloads."""
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    }
+    response = requests.get(url, headers=headers, stream=True, timeout=30)
+    response.raise_for_status()
+    # Páginas de erro (HTML) não podem ficar gravadas como XML da nota
+    content_type = response.headers.get('content-type', '')
+    if extension_for_content_type(content_type) != '.xml':
+        response.close()
+        raise ValueError(f'Resposta não é XML (Content-Type: {content_type or "ausente"})')
+    entry = download_store.save_stream(key, response.iter_content(chunk_size=8192), '.xml')
+    return os.path.join(DOWNLOAD_DIR, entry['path'])
+
+def on_prefetch_resolved(key, result):
+    """Callback do prefetch: baixa o XML quando habilitado."""
+    if not result.get('success'):
+        logging.warning(f"Prefetch falhou para a chave {key}: {result.get('message')}")
+        return
+    if PREFETCH_DOWNLOAD_XML and not get_local_xml_path(key):
+        try:
+            download_xml_to_disk(key, result['url'])
+            logging.info(f"XML pré-carregado para a chave {key}")
+        except Exception as e:
+            logging.error(f"Erro ao pré-carregar XML da chave {key}: {str(e)}")
+
+def get_nfe_url_interactive(key: str, captcha_token=None):
+    """Versão de get_nfe_url para cliques do usuário (ignora falhas transitórias em cache)."""
+    return get_nfe_url(key, captcha_token, interactive=True)
+
+prefetcher = Prefetcher(get_nfe_url, workers=PREFETCH_WORKERS, on_resolved=on_prefetch_resolved,
+                        capacity=resolver_pool.capacity, interactive_func=get_nfe_url_interactive)
+
+def schedule_prefetch(keys, captcha_token=None, priority=PRIORITY_BACKGROUND):
+    """Coloca na fila de prefetch as chaves que ainda não estão no cache."""
+    token = captcha_token or PREFETCH_TOKEN
+    if not token:
+        logging.info("Prefetch ignorado: nenhum token 2captcha disponível")
+        return 0
+    cache = load_cache()
+    queued = 0
+    for key in keys:
+        if key in cache:
+            continue
+        if prefetcher.enqueue(key, token, priority):
+            queued += 1
+    if queued:
+        logging.info(f"{queued} chaves adicionadas à fila de prefetch")
+    return queued
+
 @app.route('/')
 def index():
     """Página principal - landing page."""
@@ -154,7 +271,7 @@ def get_url(key):
     """Endpoint para obter URL de download."""
     # Obter token 2captcha do parâmetro da URL
     captcha_token = request.args.get('token')
-    result = get_nfe_url(key, captcha_token)
+    result = prefetcher.resolve_now(key, captcha_token)
     return jsonify(result)
 
 @app.route('/download/<key>', methods=['GET'])
@@ -163,13 +280,24 @@ def download_nfe(key):
     try:
         # Obter token 2captcha do parâmetro da URL, se disponível
         captcha_token = request.args.get('token')
-        
-        # Primeiro, obtém a URL
-        result = get_nfe_url(key, captcha_token)
+
+        # Se o XML já foi pré-carregado, envia direto do disco
+        local_path = get_local_xml_path(key)
+        if local_path:
+            set_processing_status(key, 'completed', 'Download concluído com sucesso')
+            return send_file(
+                os.path.abspath(local_path),
+                as_attachment=True,
+                download_name=f'NFE_{key}.xml',
+                mimetype='application/xml'
+            )
+        
+        # Primeiro, obtém a URL (passa na frente da fila de prefetch)
+        result = prefetcher.resolve_now(key, captcha_token)
         if not result['success']:
             # Registra o status de erro no servidor
             set_processing_status(key, 'error', f"Falha ao obter URL: {result['message']}")
-            return jsonify({'error': result['message']}), 400
+            return jsonify({'error': result['message'], 'failure_kind': result.get('failure_kind')}), 400
 
         # Configura headers para simular um navegador
         headers = {
@@ -256,6 +384,9 @@ def save_key():
         # Adiciona a chave ao arquivo
         with open('nfe_keys.txt', 'a') as file:
             file.write(f"\n{key}")
+
+        # Começa a resolver a URL em segundo plano
+        schedule_prefetch([key], data.get('token'), PRIORITY_SINGLE)
         
         return jsonify({'success': True, 'message': 'Chave adicionada com sucesso'})
     
@@ -306,6 +437,9 @@ def save_multiple_keys():
             with open('nfe_keys.txt', 'a') as file:
                 for key in added_keys:
                     file.write(f"\n{key}")
+
+        # Começa a resolver as URLs das novas chaves em segundo plano
+        prefetch_queued = schedule_prefetch(added_keys, data.get('token'))
         
         # Prepara a resposta
         result = {
@@ -314,7 +448,8 @@ def save_multiple_keys():
             'added_count': len(added_keys),
             'invalid_count': len(invalid_keys),
             'existing_count': existing_count,
-            'invalid_keys': invalid_keys[:10]  # Limita para não sobrecarregar a resposta
+            'invalid_keys': invalid_keys[:10],  # Limita para não sobrecarregar a resposta
+            'prefetch_queued': prefetch_queued
         }
         
         return jsonify(result)
@@ -347,11 +482,17 @@ def delete_key():
         with open('nfe_keys.txt', 'w') as file:
             file.write('\n'.join(existing_keys))
         
+        # Não gasta captcha com uma chave que não está mais na lista; cancelar antes
+        # de limpar o cache impede que uma consulta em andamento grave a chave de volta
+        prefetcher.cancel([key])
+
         # Limpa o cache para a chave removida
-        cache = load_cache()
-        if key in cache:
-            del cache[key]
-            save_cache(cache)
+        with cache_lock:
+            cache = load_cache()
+            if key in cache:
+                del cache[key]
+                save_cache(cache)
+            negative_cache.remove(key)
         
         return jsonify({'success': True, 'message': 'Chave NFe removida com sucesso'})
     
@@ -371,8 +512,14 @@ def delete_all_keys():
         with open('nfe_keys.txt', 'w') as file:
             file.write('')
         
+        # Esvazia a fila de prefetch antes de limpar o cache; consultas em
+        # andamento terminam sem gravar nos caches
+        prefetcher.clear()
+
         # Limpa todo o cache
         clear_cache()
+        with cache_lock:
+            negative_cache.purge()
         
         return jsonify({
             'success': True, 
@@ -479,6 +626,107 @@ def clear_processing_cache_endpoint():
             'message': f'Erro ao limpar cache de processamento: {str(e)}'
         }), 500
 
+@app.route('/prefetch/status', methods=['GET'])
+def prefetch_status():
+    """Endpoint para obter o estado da fila de prefetch."""
+    return jsonify({'success': True, 'prefetch': prefetcher.status()})
+
+@app.route('/prefetch/enqueue', methods=['POST'])
+def prefetch_enqueue():
+    """Endpoint para colocar chaves na fila de prefetch (todas as chaves se nenhuma for informada)."""
+    try:
+        data = request.get_json(silent=True) or {}
+        keys = data.get('keys')
+        if keys is None:
+            keys = [key for key in read_nfe_keys('nfe_keys.txt') if is_valid_nfe_key(key)]
+        else:
+            if not (isinstance(keys, list) and all(isinstance(k, str) for k in keys)):
+                return jsonify({'success': False, 'message': 'keys deve ser uma lista de chaves'}), 400
+            invalid_keys = [key for key in keys if not is_valid_nfe_key(key)]
+            if invalid_keys:
+                return jsonify({
+                    'success': False,
+                    'message': 'Formato de chave inválido. Deve ter 44 dígitos numéricos',
+                    'invalid_keys': invalid_keys[:10]
+                }), 400
+        queued = schedule_prefetch(keys, data.get('token'))
+        return jsonify({'success': True, 'queued': queued, 'prefetch': prefetcher.status()})
+    except Exception as e:
+        logging.error(f"Erro ao enfileirar prefetch: {str(e)}")
+        return jsonify({'success': False, 'message': f'Erro: {str(e)}'}), 500
+
+@app.route('/prefetch/pause', methods=['POST'])
+def prefetch_pause():
+    """Endpoint para pausar o prefetch em segundo plano."""
+    prefetcher.pause()
+    return jsonify({'success': True, 'prefetch': prefetcher.status()})
+
+@app.route('/prefetch/resume', methods=['POST'])
+def prefetch_resume():
+    """Endpoint para retomar o prefetch em segundo plano."""
+    prefetcher.resume()
+    return jsonify({'success': True, 'prefetch': prefetcher.status()})
+
+@app.route('/prefetch/concurrency', methods=['POST'])
+def prefetch_concurrency():
+    """Endpoint para alterar o número de workers do prefetch."""
+    try:
+        data = request.json or {}
+        workers = int(data.get('workers'))
+        if workers < 0:
+            raise ValueError('workers deve ser maior ou igual a zero')
+        if workers > resolver_pool.max_capacity():
+            raise ValueError(f'máximo de {resolver_pool.max_capacity()} (instâncias x RESOLVER_SLOTS)')
+        prefetcher.set_concurrency(workers)
+        return jsonify({'success': True, 'prefetch': prefetcher.status()})
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'message': f'Número de workers inválido: {str(e)}'}), 400
+
+@app.route('/resolvers/status', methods=['GET'])
+def resolvers_status():
+    """Endpoint para obter o estado das instâncias do resolvedor."""
+    return jsonify({'success': True, 'resolvers': resolver_pool.status()})
+
+@app.route('/negative-cache', methods=['GET'])
+def get_negative_cache():
+    """Endpoint para listar as chaves recusadas pelo resolvedor."""
+    try:
+        entries = negative_cache.all()
+        return jsonify({
+            'success': True,
+            'count': len(entries),
+            'ttl': negative_cache.ttl,
+            'entries': entries
+        })
+    except Exception as e:
+        logging.error(f"Erro ao obter cache negativo: {str(e)}")
+        return jsonify({'success': False, 'message': f'Erro: {str(e)}'}), 500
+
+@app.route('/negative-cache/purge', methods=['POST'])
+def purge_negative_cache():
+    """Endpoint para remover chaves do cache negativo (todas, por chave ou por tipo)."""
+    try:
+        data = request.get_json(silent=True) or {}
+        kind = data.get('kind')
+        if kind not in (None, PERMANENT, TRANSIENT):
+            return jsonify({'success': False, 'message': f'Tipo inválido: {kind}'}), 400
+        keys = data.get('keys')
+        if keys is not None and not (isinstance(keys, list) and all(isinstance(k, str) for k in keys)):
+            return jsonify({'success': False, 'message': 'keys deve ser uma lista de chaves'}), 400
+        removed = negative_cache.purge(
+            keys=set(keys) if keys is not None else None,
+            kind=kind,
+            expired_only=bool(data.get('expired_only', False))
+        )
+        return jsonify({
+            'success': True,
+            'message': f'{removed} chaves removidas do cache negativo',
+            'removed': removed
+        })
+    except Exception as e:
+        logging.error(f"Erro ao limpar cache negativo: {str(e)}")
+        return jsonify({'success': False, 'message': f'Erro: {str(e)}'}), 500
+
 def set_processing_status(key, status, message):
     """Atualiza o status de processamento de uma chave NFe."""
     try:
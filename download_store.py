@@ -0,0 +1,260 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+import zipfile
+import threading
+from datetime import datetime
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+FLAT_FILE_PATTERN = re.compile(r'^NFE_(\d{44})(\.\w+)$')
+# Só estes formatos contam como nota baixada; '.txt' guarda respostas de tipo
+# desconhecido (ex.: página de erro HTML) e a chave volta a ser processada
+DOCUMENT_EXTENSIONS = ('.xml', '.pdf')
+
+
+def parse_nfe_key(key: str) -> dict:
+    """Decodifica os campos da chave de acesso da NFe (44 dígitos)."""
+    if not (key.isdigit() and len(key) == 44):
+        raise ValueError(f'Chave NFe inválida: {key}')
+    return {
+        'uf': key[0:2],
+        'aamm': key[2:6],
+        'cnpj': key[6:20],
+        'modelo': key[20:22],
+        'serie': key[22:25],
+        'numero': key[25:34]
+    }
+
+
+def extension_for_content_type(content_type: str) -> str:
+    """Retorna a extensão do arquivo conforme o Content-Type da resposta."""
+    content_type = (content_type or '').lower()
+    if 'pdf' in content_type:
+        return '.pdf'
+    if 'xml' in content_type:
+        return '.xml'
+    return '.txt'
+
+
+def file_digest(filepath: str):
+    """Retorna (tamanho, sha256) do arquivo."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return os.path.getsize(filepath), digest.hexdigest()
+
+
+class DownloadStore:
+    """Diretório de downloads particionado por CNPJ/AAMM com manifesto de índice.
+
+    Os arquivos ficam em ``<base>/<CNPJ>/<AAMM>/NFE_<chave>.<ext>`` e cada
+    gravação é registrada em ``manifest.jsonl`` (somente acréscimo). O
+    manifesto é mantido em memória e as linhas acrescentadas por outros
+    processos são lidas a cada consulta, permitindo verificar se uma chave já
+    foi baixada sem listar o diretório.
+    """
+
+    def __init__(self, base_dir: str = 'downloads'):
+        self.base_dir = base_dir
+        self.manifest_path = os.path.join(base_dir, MANIFEST_FILENAME)
+        self.lock = threading.Lock()
+        self.index = {}
+        # Posição já lida do manifesto e inode do arquivo, para acompanhar outros processos
+        self.offset = 0
+        self.inode = None
+        os.makedirs(base_dir, exist_ok=True)
+        self.refresh()
+
+    def refresh(self):
+        """Lê as linhas novas do manifesto, inclusive as gravadas por outro processo.
+
+        Se o arquivo foi substituído ou truncado (ex.: ``rebuild_manifest``), o
+        índice é recarregado do início.
+        """
+        with self.lock:
+            try:
+                stat = os.stat(self.manifest_path)
+            except OSError:
+                self.index, self.offset, self.inode = {}, 0, None
+                return
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self.index, self.offset, self.inode = {}, 0, stat.st_ino
+            if stat.st_size == self.offset:
+                return
+            with open(self.manifest_path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+            # Só consome linhas completas; uma escrita em andamento é lida na próxima vez
+            complete = data[:data.rfind(b'\n') + 1]
+            for line in complete.decode('utf-8').splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Linha corrompida (ex.: processo interrompido durante a escrita)
+                    logging.warning(f"Linha inválida no manifesto ignorada: {line[:80]}")
+                    continue
+                self.index[entry['key']] = entry
+            self.offset += len(complete)
+
+    def shard_dir(self, key: str) -> str:
+        """Retorna o diretório relativo onde os arquivos da chave são guardados."""
+        fields = parse_nfe_key(key)
+        return os.path.join(fields['cnpj'], fields['aamm'])
+
+    def path_for(self, key: str, extension: str) -> str:
+        """Retorna o caminho absoluto (a partir da base) do arquivo da chave."""
+        return os.path.join(self.base_dir, self.shard_dir(key), f'NFE_{key}{extension}')
+
+    def get(self, key: str):
+        """Retorna a entrada do manifesto da chave, se o arquivo ainda existir."""
+        self.refresh()
+        entry = self.index.get(key)
+        if entry and os.path.exists(os.path.join(self.base_dir, entry['path'])):
+            return entry
+        return None
+
+    def has(self, key: str) -> bool:
+        """Verifica se a chave já foi baixada como XML ou PDF."""
+        entry = self.get(key)
+        return entry is not None and os.path.splitext(entry['path'])[1] in DOCUMENT_EXTENSIONS
+
+    def get_path(self, key: str):
+        """Retorna o caminho do arquivo baixado da chave, ou None."""
+        entry = self.get(key)
+        if entry:
+            return os.path.join(self.base_dir, entry['path'])
+        return None
+
+    def save_stream(self, key: str, chunks, extension: str) -> dict:
+        """Grava o conteúdo de forma atômica no diretório particionado e registra no manifesto."""
+        final_path = self.path_for(key, extension)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        tmp_path = f'{final_path}.{threading.get_ident()}.part'
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    if chunk:
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            if size == 0:
+                raise ValueError('Arquivo baixado está vazio')
+            os.replace(tmp_path, final_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return self._record(key, final_path, size, digest.hexdigest())
+
+    def add_existing(self, key: str, source_path: str) -> dict:
+        """Move um arquivo já existente para o diretório particionado e registra no manifesto.
+
+        A entrada é gravada antes de mover o arquivo: se o processo parar no
+        meio, o arquivo continua no lugar antigo e a migração pode ser repetida.
+        """
+        extension = os.path.splitext(source_path)[1]
+        final_path = self.path_for(key, extension)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        size, sha256 = file_digest(source_path)
+        entry = self._record(key, final_path, size, sha256)
+        shutil.move(source_path, final_path)
+        return entry
+
+    def _entry(self, key: str, final_path: str, size: int, sha256: str) -> dict:
+        return {
+            'key': key,
+            'path': os.path.relpath(final_path, self.base_dir),
+            'cnpj': parse_nfe_key(key)['cnpj'],
+            'size': size,
+            'sha256': sha256,
+            'timestamp': datetime.now().isoformat()
+        }
+
+    def _record(self, key: str, final_path: str, size: int, sha256: str) -> dict:
+        entry = self._entry(key, final_path, size, sha256)
+        with self.lock:
+            with open(self.manifest_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self.index[key] = entry
+        return entry
+
+    def entries_for_cnpj(self, cnpj: str):
+        """Lista as entradas do manifesto de um CNPJ."""
+        cnpj = re.sub(r'\D', '', cnpj)
+        self.refresh()
+        return [entry for entry in self.index.values() if entry.get('cnpj') == cnpj]
+
+    def export_cnpj(self, cnpj: str, output_path: str) -> int:
+        """Gera um ZIP com todos os arquivos baixados de um CNPJ. Retorna a quantidade exportada."""
+        count = 0
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for entry in self.entries_for_cnpj(cnpj):
+                filepath = os.path.join(self.base_dir, entry['path'])
+                if os.path.exists(filepath):
+                    zf.write(filepath, entry['path'])
+                    count += 1
+        return count
+
+    def migrate_flat(self) -> dict:
+        """Move arquivos do layout antigo (``<base>/NFE_<chave>.<ext>``) para o layout particionado."""
+        result = {'migrated': 0, 'skipped': 0, 'errors': 0}
+        with os.scandir(self.base_dir) as it:
+            for dir_entry in it:
+                if not dir_entry.is_file():
+                    continue
+                match = FLAT_FILE_PATTERN.match(dir_entry.name)
+                if not match:
+                    continue
+                key = match.group(1)
+                if dir_entry.stat().st_size == 0:
+                    result['skipped'] += 1
+                    continue
+                try:
+                    self.add_existing(key, dir_entry.path)
+                    result['migrated'] += 1
+                except Exception as e:
+                    logging.error(f"Erro ao migrar {dir_entry.path}: {str(e)}")
+                    result['errors'] += 1
+        return result
+
+    def rebuild_manifest(self) -> int:
+        """Reconstrói o manifesto a partir dos arquivos do layout particionado.
+
+        Usado para recuperar arquivos que estão nos diretórios por CNPJ/AAMM
+        mas não constam no manifesto. Retorna a quantidade de entradas.
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.base_dir):
+            if os.path.abspath(root) == os.path.abspath(self.base_dir):
+                # Arquivos soltos na base pertencem ao layout antigo (ver migrate_flat)
+                continue
+            for name in sorted(files):
+                match = FLAT_FILE_PATTERN.match(name)
+                if not match:
+                    continue
+                key = match.group(1)
+                filepath = os.path.join(root, name)
+                if filepath != self.path_for(key, match.group(2)) or os.path.getsize(filepath) == 0:
+                    continue
+                size, sha256 = file_digest(filepath)
+                entries.append(self._entry(key, filepath, size, sha256))
+
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+        self.refresh()
+        return len(entries)
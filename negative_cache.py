@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+NEGATIVE_CACHE_FILE = 'negative_cache.json'
+
+PERMANENT = 'permanent'
+TRANSIENT = 'transient'
+
+# Frases sobre a própria chave/nota que indicam falha definitiva. Erros genéricos
+# do navegador do resolvedor ("Resposta inválida do portal", "frame not found")
+# não podem bloquear a chave, por isso nada de termos soltos como "inválid".
+PERMANENT_MARKERS = (
+    'chave inválida', 'chave invalida',
+    'chave de acesso inválida', 'chave de acesso invalida',
+    'invalid key', 'invalid access key',
+    'nfe não encontrada', 'nfe nao encontrada',
+    'nota não encontrada', 'nota nao encontrada',
+    'nota fiscal não encontrada', 'nota fiscal nao encontrada',
+    'nfe not found',
+    'nota cancelada', 'nfe cancelada', 'nota fiscal cancelada',
+    'denegad'
+)
+
+# Falhas ligadas ao captcha/token ou a tempo esgotado não dizem nada sobre a chave
+TRANSIENT_MARKERS = ('captcha', 'token', 'timeout', 'tempo esgotado')
+
+
+def classify_failure(message) -> str:
+    """Classifica a mensagem de falha do resolvedor como permanente ou transitória.
+
+    Só frases que falam da chave/nota contam como permanentes; o resto é transitório.
+    """
+    text = (message or '').lower()
+    if any(marker in text for marker in TRANSIENT_MARKERS):
+        return TRANSIENT
+    if any(marker in text for marker in PERMANENT_MARKERS):
+        return PERMANENT
+    return TRANSIENT
+
+
+@contextmanager
+def file_lock(path: str):
+    """Trava exclusiva entre processos usando um arquivo auxiliar."""
+    with open(path, 'a+') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK desiste após ~10 s; continua esperando
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class NegativeCache:
+    """Cache de chaves recusadas pelo resolvedor, com TTL por tipo de falha.
+
+    Gravado em JSON e compartilhado entre app.py e process_nfe.py; o arquivo é
+    recarregado quando outro processo o altera. As alterações são feitas sob
+    uma trava de arquivo (``<arquivo>.lock``) e as entradas expiradas são
+    descartadas a cada gravação.
+    """
+
+    def __init__(self, filename: str = NEGATIVE_CACHE_FILE, permanent_ttl: float = None,
+                 transient_ttl: float = None):
+        self.filename = filename
+        self.ttl = {
+            PERMANENT: permanent_ttl if permanent_ttl is not None
+            else float(os.environ.get('NEGATIVE_TTL_PERMANENT', 7 * 24 * 3600)),
+            TRANSIENT: transient_ttl if transient_ttl is not None
+            else float(os.environ.get('NEGATIVE_TTL_TRANSIENT', 10 * 60))
+        }
+        self.lock_path = f"{filename}.lock"
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.mtime = None
+
+    @contextmanager
+    def _locked_update(self):
+        """Trava threads e processos e recarrega o arquivo antes de alterá-lo."""
+        with self.lock, file_lock(self.lock_path):
+            self.mtime = None
+            self._reload()
+            yield
+
+    def _reload(self):
+        try:
+            stat = os.stat(self.filename)
+            mtime = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            self.entries, self.mtime = {}, None
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                self.entries = json.load(f)
+            self.mtime = mtime
+        except Exception as e:
+            logging.error(f"Erro ao carregar cache negativo: {str(e)}")
+
+    def _save(self):
+        now = time.time()
+        self.entries = {key: entry for key, entry in self.entries.items() if entry['expires_at'] > now}
+        try:
+            tmp_file = f"{self.filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(self.entries, f, indent=4, ensure_ascii=False)
+            os.replace(tmp_file, self.filename)
+            stat = os.stat(self.filename)
+            self.mtime = (stat.st_mtime_ns, stat.st_size)
+        except Exception as e:
+            logging.error(f"Erro ao salvar cache negativo: {str(e)}")
+
+    def get(self, key: str):
+        """Retorna a entrada válida (não expirada) da chave, ou None."""
+        with self.lock:
+            self._reload()
+            entry = self.entries.get(key)
+            if entry and entry['expires_at'] > time.time():
+                return entry
+            return None
+
+    def add(self, key: str, message, kind: str = None) -> dict:
+        """Registra a falha da chave; sem ``kind`` a mensagem é classificada automaticamente."""
+        kind = kind or classify_failure(message)
+        now = time.time()
+        entry = {
+            'kind': kind,
+            'message': message,
+            'timestamp': datetime.now().isoformat(),
+            'expires_at': now + self.ttl[kind]
+        }
+        with self._locked_update():
+            self.entries[key] = entry
+            self._save()
+        return entry
+
+    def remove(self, key: str) -> bool:
+        # Verificação sem trava: o caso comum é a chave não estar no cache
+        with self.lock:
+            self._reload()
+            if key not in self.entries:
+                return False
+        with self._locked_update():
+            if key not in self.entries:
+                return False
+            del self.entries[key]
+            self._save()
+            return True
+
+    def purge(self, keys=None, kind: str = None, expired_only: bool = False) -> int:
+        """Remove entradas filtrando por chaves, tipo ou apenas as expiradas. Retorna a quantidade removida."""
+        now = time.time()
+        with self._locked_update():
+            to_remove = [
+                key for key, entry in self.entries.items()
+                if (keys is None or key in keys)
+                and (kind is None or entry['kind'] == kind)
+                and (not expired_only or entry['expires_at'] <= now)
+            ]
+            for key in to_remove:
+                del self.entries[key]
+            if to_remove:
+                self._save()
+            return len(to_remove)
+
+    def all(self) -> dict:
+        """Retorna todas as entradas válidas."""
+        now = time.time()
+        with self.lock:
+            self._reload()
+            return {key: entry for key, entry in self.entries.items() if entry['expires_at'] > now}
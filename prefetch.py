@@ -0,0 +1,249 @@
+import threading
+import queue
+import itertools
+import logging
+from datetime import datetime
+
+# Prioridades da fila (menor valor = atendido primeiro)
+PRIORITY_SINGLE = 5
+PRIORITY_BACKGROUND = 10
+
+
+class Prefetcher:
+    """Resolve URLs de NFe em segundo plano usando uma fila de prioridade.
+
+    Requisições interativas (clique do usuário) são resolvidas na hora pela
+    própria requisição HTTP. ``capacity`` (número ou função) é a quantidade de
+    consultas simultâneas que os resolvedores aguentam; os workers de segundo
+    plano só retiram novos itens da fila enquanto houver vaga livre, descontadas
+    as requisições interativas em andamento.
+    """
+
+    def __init__(self, resolve_func, workers=2, on_resolved=None, capacity=1, interactive_func=None):
+        self.resolve_func = resolve_func
+        # Função usada por resolve_now; por padrão a mesma do segundo plano
+        self.interactive_func = interactive_func or resolve_func
+        self.on_resolved = on_resolved
+        self.capacity = capacity
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = {}      # chave -> prioridade atual na fila
+        self.in_flight = {}    # chave -> threading.Event
+        self.cancelled = set()  # chaves em andamento canceladas
+        self.interactive_active = 0
+        self.background_active = 0
+        self.paused = False
+        self.target_workers = max(0, int(workers))
+        self.threads = {}      # índice -> thread
+        self.stats = {'resolved': 0, 'failed': 0, 'skipped': 0}
+        self.last_error = None
+
+    def start(self):
+        """Inicia os workers até atingir a concorrência configurada."""
+        with self.lock:
+            self.threads = {index: t for index, t in self.threads.items() if t.is_alive()}
+            # Cada índice abaixo da concorrência tem exatamente um worker; threads com
+            # índice acima dela ainda vivas terminam sozinhas
+            for index in range(self.target_workers):
+                if index in self.threads:
+                    continue
+                thread = threading.Thread(target=self._worker, args=(index,), daemon=True,
+                                          name=f'prefetch-{index}')
+                self.threads[index] = thread
+                thread.start()
+
+    def set_concurrency(self, workers):
+        """Altera o número de workers; os excedentes terminam após o item atual."""
+        with self.lock:
+            self.target_workers = max(0, int(workers))
+            self.idle.notify_all()
+        self.start()
+
+    def pause(self):
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+            self.idle.notify_all()
+
+    def enqueue(self, key, token, priority=PRIORITY_BACKGROUND):
+        """Adiciona uma chave à fila. Retorna False se já estiver na fila ou em andamento."""
+        with self.lock:
+            if key in self.in_flight:
+                return False
+            current = self.pending.get(key)
+            if current is not None and current <= priority:
+                return False
+            # Entradas antigas com prioridade maior são descartadas ao sair da fila
+            self.pending[key] = priority
+            self.queue.put((priority, next(self.counter), key, token))
+        self.start()
+        return True
+
+    def cancel(self, keys):
+        """Remove chaves da fila. Retorna quantas estavam aguardando.
+
+        Chaves já em andamento terminam a consulta, mas o callback
+        ``on_resolved`` não é chamado para elas e ``is_cancelled`` passa a
+        retornar True até o fim da consulta.
+        """
+        removed = 0
+        with self.lock:
+            for key in keys:
+                # A entrada continua na PriorityQueue e é descartada ao sair dela
+                if self.pending.pop(key, None) is not None:
+                    removed += 1
+                if key in self.in_flight:
+                    self.cancelled.add(key)
+        return removed
+
+    def is_cancelled(self, key):
+        """Indica se a chave foi cancelada enquanto estava em andamento."""
+        with self.lock:
+            return key in self.cancelled
+
+    def clear(self):
+        """Esvazia a fila de prefetch. Retorna quantas chaves foram removidas."""
+        with self.lock:
+            keys = list(self.pending) + list(self.in_flight)
+        return self.cancel(keys)
+
+    def resolve_now(self, key, token, timeout=120):
+        """Resolve uma chave para uma requisição interativa, passando na frente da fila.
+
+        Se a chave já estiver sendo resolvida em segundo plano, aguarda esse
+        resultado em vez de disparar uma segunda consulta ao resolvedor.
+        """
+        with self.lock:
+            event = self.in_flight.get(key)
+            if event is None:
+                event = threading.Event()
+                self.in_flight[key] = event
+                self.pending.pop(key, None)
+                self.interactive_active += 1
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            if not event.wait(timeout):
+                # Não dispara uma segunda consulta (paga) enquanto a primeira não termina
+                return {
+                    'success': False,
+                    'message': 'Consulta da chave ainda em andamento, tente novamente',
+                    'in_progress': True
+                }
+            return self.interactive_func(key, token)
+
+        try:
+            return self.interactive_func(key, token)
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+                self.cancelled.discard(key)
+                self.interactive_active -= 1
+                self.idle.notify_all()
+            event.set()
+
+    def status(self):
+        """Retorna o estado atual da fila para exibição."""
+        with self.lock:
+            return {
+                'queue_depth': len(self.pending),
+                'in_flight': len(self.in_flight),
+                'interactive_active': self.interactive_active,
+                'background_active': self.background_active,
+                'capacity': self._capacity(),
+                'paused': self.paused,
+                'workers': self.target_workers,
+                # Workers que podem rodar ao mesmo tempo (limitado pela capacidade dos resolvedores)
+                'effective_workers': min(self.target_workers, max(0, self._capacity() - self.interactive_active)),
+                'alive_workers': sum(1 for t in self.threads.values() if t.is_alive()),
+                'resolved': self.stats['resolved'],
+                'failed': self.stats['failed'],
+                'skipped': self.stats['skipped'],
+                'last_error': self.last_error
+            }
+
+    def _capacity(self):
+        return self.capacity() if callable(self.capacity) else self.capacity
+
+    def _can_start_background(self):
+        """Indica se há vaga nos resolvedores para mais uma consulta de segundo plano."""
+        if self.paused:
+            return False
+        return self.background_active + self.interactive_active < self._capacity()
+
+    def _next_item(self, index):
+        """Obtém o próximo item válido da fila, respeitando pausa e vagas livres."""
+        while True:
+            with self.lock:
+                while not self._can_start_background():
+                    if index >= self.target_workers:
+                        return None
+                    self.idle.wait(1)
+                if index >= self.target_workers:
+                    return None
+            try:
+                priority, _, key, token = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            with self.lock:
+                # Ignora entradas substituídas por prioridade maior ou já atendidas
+                if self.pending.get(key) != priority or key in self.in_flight:
+                    self.stats['skipped'] += 1
+                    continue
+                if not self._can_start_background():
+                    # Devolve o item e espera a vez
+                    self.queue.put((priority, next(self.counter), key, token))
+                    continue
+                del self.pending[key]
+                event = threading.Event()
+                self.in_flight[key] = event
+                self.background_active += 1
+                return key, token, event
+
+    def _worker(self, index):
+        while True:
+            item = self._next_item(index)
+            if item is None:
+                logging.info(f"Worker de prefetch {index} encerrado")
+                return
+            key, token, event = item
+            try:
+                result = self.resolve_func(key, token)
+                with self.lock:
+                    if result.get('success'):
+                        self.stats['resolved'] += 1
+                    else:
+                        self.stats['failed'] += 1
+                        self.last_error = {
+                            'key': key,
+                            'message': result.get('message'),
+                            'timestamp': datetime.now().isoformat()
+                        }
+                with self.lock:
+                    cancelled = key in self.cancelled
+                if self.on_resolved and not cancelled:
+                    self.on_resolved(key, result)
+            except Exception as e:
+                logging.error(f"Erro no prefetch da chave {key}: {str(e)}")
+                with self.lock:
+                    self.stats['failed'] += 1
+                    self.last_error = {
+                        'key': key,
+                        'message': str(e),
+                        'timestamp': datetime.now().isoformat()
+                    }
+            finally:
+                with self.lock:
+                    self.in_flight.pop(key, None)
+                    self.cancelled.discard(key)
+                    self.background_active -= 1
+                    self.idle.notify_all()
+                event.set()
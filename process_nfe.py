@@ -9,6 +9,11 @@ from urllib.parse import unquote
 import xml.etree.ElementTree as ET
 import zipfile
 import io
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from download_store import DownloadStore, extension_for_content_type
+from resolver_pool import ResolverPool
+from negative_cache import NegativeCache, PERMANENT, TRANSIENT, classify_failure
 
 # Configure logging
 log_directory = "logs"
@@ -46,23 +51,7 @@ def ensure_download_directory():
         os.makedirs(download_dir)
     return download_dir
 
-def validate_downloaded_file(filepath: str) -> bool:
-    """Valida se o arquivo baixado está íntegro."""
-    try:
-        if not os.path.exists(filepath):
-            return False
-        
-        # Verifica se o arquivo tem tamanho maior que 0
-        if os.path.getsize(filepath) == 0:
-            os.remove(filepath)  # Remove arquivo vazio
-            return False
-        
-        return True
-    except Exception as e:
-        logging.error(f"Erro ao validar arquivo {filepath}: {str(e)}")
-        return False
-
-def download_file(url: str, key: str, download_dir: str, max_retries: int = 3) -> Tuple[bool, str]:
+def download_file(url: str, key: str, store: DownloadStore, max_retries: int = 3) -> Tuple[bool, str]:
     """Faz download do arquivo e retorna tupla (sucesso, mensagem)."""
     retry_count = 0
     error_message = ""
@@ -81,30 +70,16 @@ def download_file(url: str, key: str, download_dir: str, max_retries: int = 3) -
             response.raise_for_status()
             
             # Determina a extensão do arquivo
-            content_type = response.headers.get('content-type', '').lower()
-            if 'pdf' in content_type:
-                extension = '.pdf'
-            elif 'xml' in content_type:
-                extension = '.xml'
-            else:
-                extension = '.txt'
-            
-            # Cria nome do arquivo
-            filename = os.path.join(download_dir, f"NFE_{key}{extension}")
+            extension = extension_for_content_type(response.headers.get('content-type', ''))
             
-            # Download do arquivo em chunks
-            with open(filename, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+            # Grava o arquivo no diretório particionado (atômico) e registra no manifesto
+            try:
+                entry = store.save_stream(key, response.iter_content(chunk_size=8192), extension)
+            except ValueError as e:
+                raise DownloadError(str(e))
             
-            # Valida o arquivo baixado
-            if validate_downloaded_file(filename):
-                logging.info(f"Download concluído com sucesso: {filename}")
-                return True, "Download realizado com sucesso"
-            else:
-                error_message = "Arquivo baixado está corrompido ou vazio"
-                raise DownloadError(error_message)
+            logging.info(f"Download concluído com sucesso: {entry['path']}")
+            return True, "Download realizado com sucesso"
             
         except requests.Timeout:
             error_message = "Timeout durante o download"
@@ -133,14 +108,14 @@ def read_nfe_keys(filename: str) -> List[str]:
     with open(filename, 'r') as file:
         return [line.strip() for line in file if line.strip()]
 
-def process_single_key(key: str, download_dir: str, max_retries: int = 5, retry_delay: int = 3) -> Tuple[bool, Dict]:
+def process_single_key(key: str, store: DownloadStore, pool: ResolverPool, negative_cache: NegativeCache,
+                       max_retries: int = 5, retry_delay: int = 3) -> Tuple[bool, Dict]:
     """Processa uma única chave NFE e retorna tupla (sucesso, detalhes)."""
-    # Usa o hostname atual para permitir acesso de qualquer IP local
-    api_host = os.environ.get('API_HOST', '127.0.0.1')
-    api_port = os.environ.get('API_PORT', '3002')
-    url = f"http://{api_host}:{api_port}/api/nfe/interceptar-url/{key}"
+    path = f"/api/nfe/interceptar-url/{key}"
     
     attempts = 0
+    # Última recusa transitória do resolvedor (gravada no cache só ao desistir)
+    transient_failure = None
     details = {
         "chave": key,
         "tentativas_api": 0,
@@ -149,9 +124,16 @@ def process_single_key(key: str, download_dir: str, max_retries: int = 5, retry_
         "timestamp": datetime.now().isoformat()
     }
 
+    # Chave recusada recentemente pelo resolvedor: não consulta de novo
+    failure = negative_cache.get(key)
+    if failure:
+        details["erro"] = f"Recusada anteriormente ({failure['kind']}): {failure['message']}"
+        logging.info(f"Chave {key} ignorada pelo cache negativo: {failure['message']}")
+        return False, details
+
     while attempts < max_retries:
         try:
-            response = requests.get(url)
+            response = pool.request('GET', path)
             data = response.json()
             details["tentativas_api"] += 1
 
@@ -160,15 +142,24 @@ def process_single_key(key: str, download_dir: str, max_retries: int = 5, retry_
                 logging.info(f"URL obtida para chave {key}: {download_url}")
                 
                 # Tenta fazer o download
-                success, message = download_file(download_url, key, download_dir)
+                success, message = download_file(download_url, key, store)
                 details["tentativas_download"] += 1
                 
                 if success:
+                    negative_cache.remove(key)
                     return True, details
                 else:
+                    transient_failure = None
                     details["erro"] = f"Falha no download: {message}"
             else:
-                details["erro"] = f"API retornou falha: {data.get('message', 'Sem mensagem')}"
+                api_failure = data.get('message', 'Sem mensagem')
+                details["erro"] = f"API retornou falha: {api_failure}"
+                # Recusa definitiva: repetir só gastaria captcha
+                if classify_failure(api_failure) == PERMANENT:
+                    negative_cache.add(key, api_failure, PERMANENT)
+                    logging.error(f"Chave {key} recusada definitivamente: {api_failure}")
+                    return False, details
+                transient_failure = api_failure
             
             logging.warning(f"Tentativa {attempts + 1}/{max_retries} falhou para chave {key}")
             
@@ -177,6 +168,7 @@ def process_single_key(key: str, download_dir: str, max_retries: int = 5, retry_
                 time.sleep(retry_delay)
         
         except requests.RequestException as e:
+            transient_failure = None
             details["erro"] = f"Erro na requisição: {str(e)}"
             logging.error(f"Erro de requisição para chave {key}: {str(e)}")
             attempts += 1
@@ -184,34 +176,82 @@ def process_single_key(key: str, download_dir: str, max_retries: int = 5, retry_
                 time.sleep(retry_delay)
         
         except Exception as e:
+            transient_failure = None
             details["erro"] = f"Erro inesperado: {str(e)}"
             logging.error(f"Erro inesperado para chave {key}: {str(e)}")
             attempts += 1
             if attempts < max_retries:
                 time.sleep(retry_delay)
     
+    # Evita que a próxima execução repita a chave antes do TTL transitório
+    if transient_failure:
+        negative_cache.add(key, transient_failure, TRANSIENT)
+
     logging.error(f"Falha ao processar chave {key} após {max_retries} tentativas")
     return False, details
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Download em lote de NFEs")
+    parser.add_argument("--input", default="nfe_keys.txt", help="Arquivo com as chaves NFE")
+    parser.add_argument("--migrate", action="store_true",
+                        help="Migra downloads do layout antigo (plano) para o layout por CNPJ/AAMM")
+    parser.add_argument("--rebuild-manifest", action="store_true",
+                        help="Reconstrói o manifesto a partir dos arquivos já no layout por CNPJ/AAMM")
+    parser.add_argument("--export-cnpj", metavar="CNPJ", help="Exporta os arquivos de um CNPJ para um ZIP")
+    parser.add_argument("--output", help="Arquivo ZIP de saída do --export-cnpj")
+    parser.add_argument("--workers", type=int,
+                        help="Chaves processadas em paralelo (padrão: resolvedores x RESOLVER_SLOTS)")
+    return parser.parse_args()
+
 def main():
-    input_file = "nfe_keys.txt"
+    args = parse_args()
+    input_file = args.input
     failed_keys = []
     
     try:
-        download_dir = ensure_download_directory()
+        store = DownloadStore(ensure_download_directory())
+
+        if args.migrate:
+            result = store.migrate_flat()
+            logging.info(f"Migração concluída: {result['migrated']} movidos, "
+                         f"{result['skipped']} ignorados, {result['errors']} erros")
+            return
+
+        if args.rebuild_manifest:
+            count = store.rebuild_manifest()
+            logging.info(f"Manifesto reconstruído com {count} arquivos")
+            return
+
+        if args.export_cnpj:
+            output = args.output or f"NFE_{args.export_cnpj}.zip"
+            count = store.export_cnpj(args.export_cnpj, output)
+            logging.info(f"{count} arquivos exportados para {output}")
+            return
+
         keys = read_nfe_keys(input_file)
         logging.info(f"Encontradas {len(keys)} chaves para processar")
 
         successful_keys = 0
         failed_keys_count = 0
 
-        for key in keys:
-            success, details = process_single_key(key, download_dir)
-            if success:
-                successful_keys += 1
-            else:
-                failed_keys_count += 1
-                failed_keys.append(details)
+        pending_keys = [key for key in keys if not store.has(key)]
+        skipped_keys = len(keys) - len(pending_keys)
+
+        # Resolvedores configurados em RESOLVER_URLS (ou API_HOST/API_PORT)
+        pool = ResolverPool.from_env()
+        negative_cache = NegativeCache()
+        workers = args.workers or pool.max_capacity()
+        logging.info(f"Usando {len(pool.endpoints)} resolvedor(es) com {workers} worker(s)")
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(process_single_key, key, store, pool, negative_cache) for key in pending_keys]
+            for future in as_completed(futures):
+                success, details = future.result()
+                if success:
+                    successful_keys += 1
+                else:
+                    failed_keys_count += 1
+                    failed_keys.append(details)
 
         # Salva informações sobre falhas
         if failed_keys:
@@ -221,6 +261,7 @@ def main():
         logging.info("Processamento concluído!")
         logging.info(f"Downloads com sucesso: {successful_keys}")
         logging.info(f"Downloads com falha: {failed_keys_count}")
+        logging.info(f"Já baixados anteriormente: {skipped_keys}")
 
     except Exception as e:
         logging.error(f"Erro no processo principal: {str(e)}")
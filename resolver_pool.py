@@ -0,0 +1,209 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+import requests
+
+
+def endpoints_from_env():
+    """Lê a lista de resolvedores de RESOLVER_URLS (separados por vírgula).
+
+    Sem RESOLVER_URLS, usa uma única instância em API_HOST/API_PORT.
+    """
+    urls = os.environ.get('RESOLVER_URLS', '')
+    endpoints = [url.strip().rstrip('/') for url in urls.split(',') if url.strip()]
+    if not endpoints:
+        api_host = os.environ.get('API_HOST', '127.0.0.1')
+        api_port = os.environ.get('API_PORT', '3002')
+        endpoints = [f"http://{api_host}:{api_port}"]
+    return endpoints
+
+
+class ResolverEndpoint:
+    """Estado de uma instância do interceptar-url."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.outstanding = 0
+        self.total = 0
+        # Falhas seguidas nas requisições reais (passivo)
+        self.request_failures = 0
+        # Resultados seguidos do health check (ativo)
+        self.check_failures = 0
+        self.check_successes = 0
+        self.healthy = True
+        self.ejected_at = None
+        self.last_error = None
+
+    def to_dict(self):
+        return {
+            'url': self.base_url,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'total': self.total,
+            'request_failures': self.request_failures,
+            'check_failures': self.check_failures,
+            'ejected_at': self.ejected_at,
+            'last_error': self.last_error
+        }
+
+
+class ResolverPool:
+    """Distribui requisições entre instâncias do resolvedor.
+
+    Escolhe a instância saudável com menos requisições em andamento. Após
+    ``failure_threshold`` falhas seguidas (erro de conexão, timeout ou HTTP 5xx)
+    nas requisições reais, ou no health check, a instância é retirada do pool.
+    Os dois contadores são independentes: um health check bem-sucedido não zera
+    as falhas das requisições. Só o health check readmite a instância, depois de
+    ``recovery_threshold`` verificações bem-sucedidas seguidas.
+    """
+
+    def __init__(self, endpoints=None, failure_threshold: int = 3, recovery_threshold: int = 2,
+                 health_interval: float = 10, health_path: str = '/', health_timeout: float = 5,
+                 request_timeout: float = 180, slots_per_endpoint: int = 1):
+        endpoints = endpoints or endpoints_from_env()
+        self.endpoints = [ResolverEndpoint(url) for url in endpoints]
+        self.failure_threshold = failure_threshold
+        self.recovery_threshold = recovery_threshold
+        self.health_interval = health_interval
+        self.health_path = health_path
+        self.health_timeout = health_timeout
+        # Cada resolução envolve captcha e leva de 20 a 60 s; o limite só corta instâncias travadas
+        self.request_timeout = request_timeout
+        # Consultas simultâneas que cada instância aguenta (limita o prefetch)
+        self.slots_per_endpoint = max(1, int(slots_per_endpoint))
+        self.lock = threading.Lock()
+        self.health_thread = None
+
+    @classmethod
+    def from_env(cls):
+        """Cria o pool a partir das variáveis de ambiente RESOLVER_*."""
+        return cls(
+            endpoints_from_env(),
+            failure_threshold=int(os.environ.get('RESOLVER_FAILURE_THRESHOLD', '3')),
+            recovery_threshold=int(os.environ.get('RESOLVER_RECOVERY_THRESHOLD', '2')),
+            health_interval=float(os.environ.get('RESOLVER_HEALTH_INTERVAL', '10')),
+            health_path=os.environ.get('RESOLVER_HEALTH_PATH', '/'),
+            health_timeout=float(os.environ.get('RESOLVER_HEALTH_TIMEOUT', '5')),
+            request_timeout=float(os.environ.get('RESOLVER_TIMEOUT', '180')),
+            slots_per_endpoint=int(os.environ.get('RESOLVER_SLOTS', '1'))
+        )
+
+    def start_health_checks(self):
+        """Inicia o health check ativo em segundo plano (uma única vez)."""
+        with self.lock:
+            if self.health_thread and self.health_thread.is_alive():
+                return
+            self.health_thread = threading.Thread(target=self._health_loop, daemon=True,
+                                                  name='resolver-health')
+            self.health_thread.start()
+
+    def _select(self):
+        healthy = [ep for ep in self.endpoints if ep.healthy]
+        # Com todas as instâncias fora, tenta mesmo assim em vez de falhar direto
+        candidates = healthy or self.endpoints
+        return min(candidates, key=lambda ep: (ep.outstanding, ep.total))
+
+    def capacity(self) -> int:
+        """Consultas simultâneas suportadas pelas instâncias disponíveis (todas, se nenhuma estiver saudável)."""
+        with self.lock:
+            healthy = sum(1 for ep in self.endpoints if ep.healthy)
+        return (healthy or len(self.endpoints)) * self.slots_per_endpoint
+
+    def max_capacity(self) -> int:
+        """Consultas simultâneas suportadas com todas as instâncias saudáveis."""
+        return len(self.endpoints) * self.slots_per_endpoint
+
+    @contextmanager
+    def acquire(self):
+        """Reserva a instância com menos requisições em andamento."""
+        self.start_health_checks()
+        with self.lock:
+            endpoint = self._select()
+            endpoint.outstanding += 1
+            endpoint.total += 1
+        try:
+            yield endpoint
+        finally:
+            with self.lock:
+                endpoint.outstanding -= 1
+
+    def request(self, method: str, path: str, **kwargs):
+        """Envia a requisição para uma instância do pool e registra o resultado.
+
+        Sem ``timeout`` explícito usa ``request_timeout``; o timeout conta como
+        falha da instância.
+        """
+        kwargs.setdefault('timeout', self.request_timeout)
+        with self.acquire() as endpoint:
+            try:
+                response = requests.request(method, f"{endpoint.base_url}{path}", **kwargs)
+            except requests.RequestException as e:
+                self.mark_failure(endpoint, str(e))
+                raise
+            if response.status_code >= 500:
+                self.mark_failure(endpoint, f"HTTP {response.status_code}")
+            else:
+                self.mark_success(endpoint)
+            return response
+
+    def _eject(self, endpoint: ResolverEndpoint, error: str):
+        endpoint.healthy = False
+        endpoint.ejected_at = time.time()
+        endpoint.check_successes = 0
+        logging.warning(f"Resolvedor {endpoint.base_url} removido do pool: {error}")
+
+    def mark_failure(self, endpoint: ResolverEndpoint, error: str):
+        """Registra a falha de uma requisição real."""
+        with self.lock:
+            endpoint.request_failures += 1
+            endpoint.last_error = error
+            if endpoint.healthy and endpoint.request_failures >= self.failure_threshold:
+                self._eject(endpoint, error)
+
+    def mark_success(self, endpoint: ResolverEndpoint):
+        """Registra o sucesso de uma requisição real (não readmite instâncias removidas)."""
+        with self.lock:
+            endpoint.request_failures = 0
+
+    def mark_check_failure(self, endpoint: ResolverEndpoint, error: str):
+        with self.lock:
+            endpoint.check_failures += 1
+            endpoint.check_successes = 0
+            endpoint.last_error = error
+            if endpoint.healthy and endpoint.check_failures >= self.failure_threshold:
+                self._eject(endpoint, error)
+
+    def mark_check_success(self, endpoint: ResolverEndpoint):
+        with self.lock:
+            endpoint.check_failures = 0
+            endpoint.check_successes += 1
+            if not endpoint.healthy and endpoint.check_successes >= self.recovery_threshold:
+                endpoint.healthy = True
+                endpoint.ejected_at = None
+                endpoint.request_failures = 0
+                logging.info(f"Resolvedor {endpoint.base_url} readmitido no pool")
+
+    def check_endpoint(self, endpoint: ResolverEndpoint):
+        """Verifica uma instância; qualquer resposta abaixo de 500 conta como saudável."""
+        try:
+            response = requests.get(f"{endpoint.base_url}{self.health_path}", timeout=self.health_timeout)
+            if response.status_code >= 500:
+                self.mark_check_failure(endpoint, f"Health check HTTP {response.status_code}")
+            else:
+                self.mark_check_success(endpoint)
+        except requests.RequestException as e:
+            self.mark_check_failure(endpoint, f"Health check: {str(e)}")
+
+    def _health_loop(self):
+        while True:
+            for endpoint in self.endpoints:
+                self.check_endpoint(endpoint)
+            time.sleep(self.health_interval)
+
+    def status(self):
+        """Retorna o estado de cada instância do pool."""
+        with self.lock:
+            return [ep.to_dict() for ep in self.endpoints]
@@ -0,0 +1,58 @@
+import importlib
+
+import pytest
+
+from download_store import DownloadStore
+from negative_cache import NegativeCache
+
+
+class StubResponse:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+
+    def json(self):
+        return self.data
+
+
+class StubPool:
+    """Substitui o ResolverPool: devolve respostas fixas e registra as chamadas."""
+
+    def __init__(self, responses=None):
+        self.responses = list(responses or [])
+        self.calls = []
+        self.endpoints = ['http://stub']
+
+    def request(self, method, path, **kwargs):
+        self.calls.append((method, path, kwargs))
+        data = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        return StubResponse(data)
+
+    def capacity(self):
+        return 1
+
+    def max_capacity(self):
+        return 1
+
+    def status(self):
+        return []
+
+
+@pytest.fixture
+def stub_pool():
+    """Fábrica de StubPool com as respostas JSON informadas."""
+    return StubPool
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """Importa app.py com caches e downloads isolados em um diretório temporário."""
+    monkeypatch.chdir(tmp_path)
+    app = importlib.import_module('app')
+    monkeypatch.setattr(app, 'negative_cache', NegativeCache(str(tmp_path / 'negative_cache.json')))
+    monkeypatch.setattr(app, 'download_store', DownloadStore(str(tmp_path / 'downloads')))
+    monkeypatch.setattr(app, 'resolver_pool', StubPool([{'success': False, 'message': 'erro'}]))
+    app.prefetcher.pause()
+    app.prefetcher.clear()
+    yield app
+    app.prefetcher.clear()
@@ -0,0 +1,49 @@
+KEY = '51240228517882000186550010000090581000271741'
+
+
+def test_prefetch_enqueue_validates_keys(app_module):
+    client = app_module.app.test_client()
+
+    response = client.post('/prefetch/enqueue', json={'keys': KEY, 'token': 't'})
+    assert response.status_code == 400
+
+    response = client.post('/prefetch/enqueue', json={'keys': [KEY, '123'], 'token': 't'})
+    assert response.status_code == 400
+    assert response.get_json()['invalid_keys'] == ['123']
+    assert app_module.prefetcher.status()['queue_depth'] == 0
+
+    response = client.post('/prefetch/enqueue', json={'keys': [KEY], 'token': 't'})
+    assert response.status_code == 200
+    assert response.get_json()['queued'] == 1
+
+
+def test_negative_cache_purge_validates_keys(app_module):
+    client = app_module.app.test_client()
+    response = client.post('/negative-cache/purge', json={'keys': KEY})
+    assert response.status_code == 400
+
+
+def test_get_nfe_url_returns_cached_permanent_failure(app_module, stub_pool):
+    app_module.resolver_pool = stub_pool([{'success': True, 'url': 'http://nfe'}])
+    app_module.negative_cache.add(KEY, 'NFe não encontrada')
+
+    for interactive in (False, True):
+        result = app_module.get_nfe_url(KEY, 't', interactive=interactive)
+        assert result['success'] is False
+        assert result['negative_cache'] is True
+        assert result['failure_kind'] == 'permanent'
+    assert app_module.resolver_pool.calls == []
+
+
+def test_get_nfe_url_interactive_bypasses_transient_failure(app_module, stub_pool):
+    app_module.resolver_pool = stub_pool([{'success': True, 'url': 'http://nfe'}])
+    app_module.negative_cache.add(KEY, 'Falha ao resolver captcha')
+
+    result = app_module.get_nfe_url(KEY, 't')
+    assert result['negative_cache'] is True
+    assert app_module.resolver_pool.calls == []
+
+    result = app_module.get_nfe_url(KEY, 't', interactive=True)
+    assert result['success'] is True
+    assert len(app_module.resolver_pool.calls) == 1
+    assert app_module.negative_cache.get(KEY) is None
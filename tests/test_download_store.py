@@ -0,0 +1,104 @@
+import json
+import os
+import zipfile
+
+import pytest
+
+from download_store import DownloadStore, extension_for_content_type, parse_nfe_key
+
+KEY = '51240228517882000186550010000090581000271741'
+OTHER_KEY = '51250327960107000138550010000100521004446368'
+
+
+def test_parse_nfe_key():
+    fields = parse_nfe_key(KEY)
+    assert fields['uf'] == '51'
+    assert fields['aamm'] == '2402'
+    assert fields['cnpj'] == '28517882000186'
+    with pytest.raises(ValueError):
+        parse_nfe_key('123')
+
+
+def test_save_stream_writes_sharded_file_and_manifest(tmp_path):
+    store = DownloadStore(str(tmp_path))
+    entry = store.save_stream(KEY, [b'<nfe/>'], '.xml')
+
+    assert entry['path'] == os.path.join('28517882000186', '2402', f'NFE_{KEY}.xml')
+    assert entry['size'] == 6
+    assert store.has(KEY)
+    with open(tmp_path / 'manifest.jsonl') as f:
+        assert json.loads(f.readline())['key'] == KEY
+
+
+def test_save_stream_rejects_empty_file(tmp_path):
+    store = DownloadStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.save_stream(KEY, [b''], '.xml')
+    assert not store.has(KEY)
+    assert not os.path.exists(store.path_for(KEY, '.xml'))
+
+
+def test_manifest_written_by_other_process_is_picked_up(tmp_path):
+    reader = DownloadStore(str(tmp_path))
+    writer = DownloadStore(str(tmp_path))
+    assert not reader.has(KEY)
+    writer.save_stream(KEY, [b'x'], '.xml')
+    assert reader.has(KEY)
+
+
+def test_migrate_flat(tmp_path):
+    (tmp_path / f'NFE_{KEY}.xml').write_bytes(b'<nfe/>')
+    (tmp_path / f'NFE_{OTHER_KEY}.pdf').write_bytes(b'')
+    (tmp_path / 'notas.txt').write_text('ignorado')
+
+    store = DownloadStore(str(tmp_path))
+    result = store.migrate_flat()
+
+    assert result == {'migrated': 1, 'skipped': 1, 'errors': 0}
+    assert not (tmp_path / f'NFE_{KEY}.xml').exists()
+    assert store.get_path(KEY) == store.path_for(KEY, '.xml')
+    # Uma segunda execução não encontra nada para migrar
+    assert store.migrate_flat()['migrated'] == 0
+
+
+def test_rebuild_manifest_recovers_unrecorded_files(tmp_path):
+    store = DownloadStore(str(tmp_path))
+    store.save_stream(KEY, [b'<nfe/>'], '.xml')
+    os.remove(tmp_path / 'manifest.jsonl')
+    assert not store.has(KEY)
+
+    assert store.rebuild_manifest() == 1
+    assert store.has(KEY)
+    assert DownloadStore(str(tmp_path)).has(KEY)
+
+
+def test_export_cnpj(tmp_path):
+    store = DownloadStore(str(tmp_path / 'downloads'))
+    store.save_stream(KEY, [b'a'], '.xml')
+    store.save_stream(OTHER_KEY, [b'b'], '.xml')
+
+    output = tmp_path / 'export.zip'
+    assert store.export_cnpj('28.517.882/0001-86', str(output)) == 1
+    with zipfile.ZipFile(output) as zf:
+        assert zf.namelist() == [os.path.join('28517882000186', '2402', f'NFE_{KEY}.xml')]
+
+
+def test_txt_download_does_not_count_as_downloaded(tmp_path):
+    store = DownloadStore(str(tmp_path))
+    store.save_stream(KEY, [b'<html>erro</html>'], '.txt')
+    assert store.get(KEY) is not None
+    assert not store.has(KEY)
+
+    store.save_stream(KEY, [b'<nfe/>'], '.xml')
+    assert store.has(KEY)
+
+
+@pytest.mark.parametrize('content_type, extension', [
+    ('application/xml; charset=utf-8', '.xml'),
+    ('text/xml', '.xml'),
+    ('application/pdf', '.pdf'),
+    ('text/html', '.txt'),
+    (None, '.txt'),
+])
+def test_extension_for_content_type(content_type, extension):
+    assert extension_for_content_type(content_type) == extension
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+from negative_cache import NegativeCache, classify_failure, PERMANENT, TRANSIENT
+
+
+@pytest.mark.parametrize('message', [
+    'NFe não encontrada',
+    'Chave inválida',
+    'Nota fiscal cancelada',
+    'Uso denegado',
+    'Chave de acesso inválida',
+    'NFe not found',
+])
+def test_classify_permanent(message):
+    assert classify_failure(message) == PERMANENT
+
+
+@pytest.mark.parametrize('message', [
+    'Token 2captcha inválido',
+    'Falha ao resolver captcha',
+    'Timeout ao consultar o portal',
+    'Erro desconhecido',
+    'Resposta inválida do portal',
+    'invalid session id',
+    'frame not found',
+    'Element not found: #btnConsultar',
+    'Elemento não encontrado na página',
+    'Navigation cancelled',
+    None,
+])
+def test_classify_transient(message):
+    assert classify_failure(message) == TRANSIENT
+
+
+def test_add_get_and_ttl(tmp_path):
+    cache = NegativeCache(str(tmp_path / 'neg.json'), permanent_ttl=3600, transient_ttl=-1)
+    assert cache.add('a', 'NFe não encontrada')['kind'] == PERMANENT
+    cache.add('b', 'erro qualquer')
+
+    assert cache.get('a')['kind'] == PERMANENT
+    # TTL transitório negativo: a entrada já nasce expirada
+    assert cache.get('b') is None
+    assert list(cache.all()) == ['a']
+
+
+def test_expired_entries_are_pruned_on_save(tmp_path):
+    filename = tmp_path / 'neg.json'
+    NegativeCache(str(filename), transient_ttl=-1).add('old', 'erro')
+    NegativeCache(str(filename)).add('new', 'erro')
+    with open(filename) as f:
+        assert list(json.load(f)) == ['new']
+
+
+def test_shared_file_between_instances(tmp_path):
+    filename = str(tmp_path / 'neg.json')
+    first = NegativeCache(filename)
+    second = NegativeCache(filename)
+    first.add('a', 'Nota cancelada')
+    second.add('b', 'Nota cancelada')
+    assert set(first.all()) == {'a', 'b'}
+
+    assert second.remove('a')
+    assert not second.remove('a')
+    assert first.get('a') is None
+
+
+def test_purge_filters(tmp_path):
+    cache = NegativeCache(str(tmp_path / 'neg.json'))
+    cache.add('a', 'Nota cancelada')
+    cache.add('b', 'erro')
+    cache.add('c', 'erro')
+
+    assert cache.purge(kind=TRANSIENT, keys={'b'}) == 1
+    assert cache.purge(kind=PERMANENT) == 1
+    assert cache.purge() == 1
+    assert cache.all() == {}
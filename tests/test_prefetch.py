@@ -0,0 +1,147 @@
+import threading
+import time
+
+from prefetch import Prefetcher, PRIORITY_SINGLE, PRIORITY_BACKGROUND
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class Recorder:
+    def __init__(self, block=None):
+        self.calls = []
+        self.block = block
+
+    def __call__(self, key, token):
+        self.calls.append(key)
+        if self.block:
+            self.block.wait(5)
+        return {'success': True, 'url': f'http://x/{key}'}
+
+
+def test_higher_priority_is_resolved_first():
+    recorder = Recorder()
+    prefetcher = Prefetcher(recorder, workers=1)
+    prefetcher.pause()
+    prefetcher.enqueue('a', 't', PRIORITY_BACKGROUND)
+    prefetcher.enqueue('b', 't', PRIORITY_BACKGROUND)
+    prefetcher.enqueue('c', 't', PRIORITY_SINGLE)
+    assert prefetcher.status()['queue_depth'] == 3
+
+    prefetcher.resume()
+    assert wait_until(lambda: len(recorder.calls) == 3)
+    assert recorder.calls == ['c', 'a', 'b']
+
+
+def test_pause_holds_queue():
+    recorder = Recorder()
+    prefetcher = Prefetcher(recorder, workers=1)
+    prefetcher.pause()
+    prefetcher.enqueue('a', 't')
+    time.sleep(0.3)
+    assert recorder.calls == []
+    assert prefetcher.status()['paused'] is True
+
+    prefetcher.resume()
+    assert wait_until(lambda: recorder.calls == ['a'])
+
+
+def test_enqueue_deduplicates_and_promotes():
+    recorder = Recorder()
+    prefetcher = Prefetcher(recorder, workers=1)
+    prefetcher.pause()
+    assert prefetcher.enqueue('a', 't', PRIORITY_BACKGROUND)
+    assert not prefetcher.enqueue('a', 't', PRIORITY_BACKGROUND)
+    # Prioridade maior substitui a entrada anterior
+    assert prefetcher.enqueue('a', 't', PRIORITY_SINGLE)
+
+    prefetcher.resume()
+    assert wait_until(lambda: prefetcher.status()['skipped'] == 1)
+    assert recorder.calls == ['a']
+
+
+def test_cancel_and_clear_drop_pending_keys():
+    recorder = Recorder()
+    prefetcher = Prefetcher(recorder, workers=1)
+    prefetcher.pause()
+    for key in ('a', 'b', 'c'):
+        prefetcher.enqueue(key, 't')
+    assert prefetcher.cancel(['b']) == 1
+    assert prefetcher.status()['queue_depth'] == 2
+    assert prefetcher.clear() == 2
+    assert prefetcher.status()['queue_depth'] == 0
+
+    prefetcher.resume()
+    time.sleep(0.3)
+    assert recorder.calls == []
+
+
+def test_resolve_now_reuses_in_flight_resolution():
+    block = threading.Event()
+    recorder = Recorder(block)
+    prefetcher = Prefetcher(recorder, workers=1)
+    prefetcher.enqueue('a', 't')
+    assert wait_until(lambda: recorder.calls == ['a'])
+
+    # Não dispara uma segunda consulta enquanto a primeira não termina
+    result = prefetcher.resolve_now('a', 't', timeout=0.1)
+    assert result['in_progress'] is True
+    assert recorder.calls == ['a']
+    block.set()
+
+
+def test_background_uses_only_free_capacity():
+    block = threading.Event()
+    recorder = Recorder(block)
+    prefetcher = Prefetcher(recorder, workers=3, capacity=2)
+    for key in ('a', 'b', 'c'):
+        prefetcher.enqueue(key, 't')
+    assert wait_until(lambda: prefetcher.status()['background_active'] == 2)
+    time.sleep(0.2)
+    assert prefetcher.status()['background_active'] == 2
+    assert prefetcher.status()['effective_workers'] == 2
+    block.set()
+    assert wait_until(lambda: len(recorder.calls) == 3)
+
+
+def test_cancel_marks_in_flight_key_and_skips_callback():
+    block = threading.Event()
+    resolved = []
+    recorder = Recorder(block)
+    prefetcher = Prefetcher(recorder, workers=1, on_resolved=lambda key, result: resolved.append(key))
+    prefetcher.enqueue('a', 't')
+    assert wait_until(lambda: recorder.calls == ['a'])
+
+    prefetcher.clear()
+    assert prefetcher.is_cancelled('a')
+    block.set()
+    assert wait_until(lambda: prefetcher.status()['in_flight'] == 0)
+    assert resolved == []
+    assert not prefetcher.is_cancelled('a')
+
+
+def test_set_concurrency_keeps_one_worker_per_index():
+    prefetcher = Prefetcher(Recorder(), workers=3, capacity=3)
+    prefetcher.start()
+    original = dict(prefetcher.threads)
+
+    # Simula o worker 1 já encerrado enquanto o 2 ainda não percebeu a redução
+    prefetcher.set_concurrency(1)
+    assert wait_until(lambda: not original[1].is_alive() and not original[2].is_alive())
+    prefetcher.threads[2] = original[2]
+    original[2].is_alive = lambda: True
+
+    prefetcher.set_concurrency(3)
+    assert sorted(prefetcher.threads) == [0, 1, 2]
+    assert prefetcher.threads[2] is original[2]
+    assert prefetcher.threads[1] is not original[1]
+
+    del original[2].is_alive
+    prefetcher.set_concurrency(2)
+    assert wait_until(lambda: prefetcher.status()['alive_workers'] == 2)
@@ -0,0 +1,54 @@
+import importlib
+
+import pytest
+
+from download_store import DownloadStore
+from negative_cache import NegativeCache, PERMANENT
+
+KEY = '51240228517882000186550010000090581000271741'
+
+
+@pytest.fixture
+def process_nfe(tmp_path, monkeypatch):
+    # O módulo cria a pasta de logs no diretório atual ao ser importado
+    monkeypatch.chdir(tmp_path)
+    return importlib.import_module('process_nfe')
+
+
+@pytest.fixture
+def store(tmp_path):
+    return DownloadStore(str(tmp_path / 'downloads'))
+
+
+@pytest.fixture
+def negative_cache(tmp_path):
+    return NegativeCache(str(tmp_path / 'negative_cache.json'))
+
+
+def test_permanent_rejection_stops_after_one_call(process_nfe, store, negative_cache, stub_pool):
+    pool = stub_pool([{'success': False, 'message': 'NFe não encontrada'}])
+    success, details = process_nfe.process_single_key(KEY, store, pool, negative_cache, retry_delay=0)
+
+    assert not success
+    assert len(pool.calls) == 1
+    assert details['tentativas_api'] == 1
+    assert negative_cache.get(KEY)['kind'] == PERMANENT
+
+
+def test_transient_rejection_retries_then_caches(process_nfe, store, negative_cache, stub_pool):
+    pool = stub_pool([{'success': False, 'message': 'Falha ao resolver captcha'}])
+    success, _ = process_nfe.process_single_key(KEY, store, pool, negative_cache, max_retries=3, retry_delay=0)
+
+    assert not success
+    assert len(pool.calls) == 3
+    assert negative_cache.get(KEY)['kind'] == 'transient'
+
+
+def test_cached_key_is_skipped(process_nfe, store, negative_cache, stub_pool):
+    negative_cache.add(KEY, 'Nota cancelada')
+    pool = stub_pool([{'success': True, 'url': 'http://nfe'}])
+    success, details = process_nfe.process_single_key(KEY, store, pool, negative_cache, retry_delay=0)
+
+    assert not success
+    assert pool.calls == []
+    assert details['tentativas_api'] == 0
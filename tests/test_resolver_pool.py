@@ -0,0 +1,115 @@
+import pytest
+import requests
+
+import resolver_pool
+from resolver_pool import ResolverPool, endpoints_from_env
+
+A = 'http://a:3002'
+B = 'http://b:3002'
+
+
+class FakeResponse:
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = ResolverPool([A, B], failure_threshold=2, recovery_threshold=2)
+    # Sem thread de health check nos testes; as verificações são chamadas manualmente
+    monkeypatch.setattr(pool, 'start_health_checks', lambda: None)
+    return pool
+
+
+def endpoint(pool, url):
+    return next(ep for ep in pool.endpoints if ep.base_url == url)
+
+
+def test_endpoints_from_env(monkeypatch):
+    monkeypatch.setenv('RESOLVER_URLS', 'http://x:1/, http://y:2')
+    assert endpoints_from_env() == ['http://x:1', 'http://y:2']
+    monkeypatch.delenv('RESOLVER_URLS')
+    monkeypatch.setenv('API_HOST', '10.0.0.1')
+    monkeypatch.setenv('API_PORT', '4000')
+    assert endpoints_from_env() == ['http://10.0.0.1:4000']
+
+
+def test_least_outstanding_selection(pool):
+    with pool.acquire() as first:
+        with pool.acquire() as second:
+            assert {first.base_url, second.base_url} == {A, B}
+        with pool.acquire() as third:
+            assert third.base_url == second.base_url
+
+
+def test_request_uses_default_timeout(pool, monkeypatch):
+    seen = {}
+
+    def fake_request(method, url, **kwargs):
+        seen.update(kwargs)
+        return FakeResponse()
+
+    monkeypatch.setattr(resolver_pool.requests, 'request', fake_request)
+    pool.request('GET', '/api')
+    assert seen['timeout'] == pool.request_timeout
+
+
+def test_request_failures_eject_and_only_health_check_readmits(pool, monkeypatch):
+    def fake_request(method, url, **kwargs):
+        if url.startswith(A):
+            return FakeResponse(500)
+        return FakeResponse(200)
+
+    monkeypatch.setattr(resolver_pool.requests, 'request', fake_request)
+    monkeypatch.setattr(resolver_pool.requests, 'get', lambda url, **kwargs: FakeResponse(404))
+
+    a = endpoint(pool, A)
+    pool.mark_failure(a, 'HTTP 500')
+    # Um health check bem-sucedido não zera as falhas das requisições reais
+    pool.check_endpoint(a)
+    pool.mark_failure(a, 'HTTP 500')
+    assert not a.healthy
+    assert pool.capacity() == 1
+
+    for _ in range(4):
+        with pool.acquire() as ep:
+            assert ep.base_url == B
+
+    # Sucesso em requisição real não readmite
+    pool.mark_success(a)
+    assert not a.healthy
+
+    pool.check_endpoint(a)
+    assert not a.healthy
+    pool.check_endpoint(a)
+    assert a.healthy
+    assert a.request_failures == 0
+
+
+def test_health_check_failures_eject(pool, monkeypatch):
+    def fake_get(url, **kwargs):
+        raise requests.ConnectionError('recusado')
+
+    monkeypatch.setattr(resolver_pool.requests, 'get', fake_get)
+    b = endpoint(pool, B)
+    pool.check_endpoint(b)
+    assert b.healthy
+    pool.check_endpoint(b)
+    assert not b.healthy
+
+
+def test_capacity_counts_slots_per_healthy_endpoint():
+    pool = ResolverPool([A, B], slots_per_endpoint=3)
+    assert pool.capacity() == 6
+    assert pool.max_capacity() == 6
+    pool.endpoints[0].healthy = False
+    assert pool.capacity() == 3
+    assert pool.max_capacity() == 6
+
+
+def test_all_ejected_still_tries(pool):
+    for ep in pool.endpoints:
+        ep.healthy = False
+    assert pool.capacity() == 2
+    with pool.acquire() as ep:
+        assert ep.base_url in (A, B)